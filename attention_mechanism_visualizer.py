@@ -25,14 +25,17 @@ After reviewing this notebook, you will be able to:
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
-import seaborn as sns
 import math
+import functools
 from matplotlib.colors import LinearSegmentedColormap
 
 # for reproducibility
-np.random.seed(42)
+rng = np.random.default_rng(42)
 tf.random.set_seed(42)
 
+# bfloat16 compute with float32 variables; softmax statistics stay in float32
+tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
 # custom colormap
 attention_colors = LinearSegmentedColormap.from_list(
     'attention_cmap', ['#f7fbff', '#6baed6', '#08519c']
@@ -44,87 +47,208 @@ We'll implement self-attention as described in the "Attention Is All You Need" p
 """
 
 class SelfAttention(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads):
+    def __init__(self, d_model, num_heads, block_size=64):
         """
         Self-attention layer with multiple heads.
 
         Args:
             d_model: Dimensionality of the input embeddings
             num_heads: Number of attention heads
+            block_size: Key/value tile size used by the tiled attention kernel
         """
         super(SelfAttention, self).__init__()
 
         self.d_model = d_model
         self.num_heads = num_heads
         self.depth = d_model // num_heads
+        self.scale = 1.0 / math.sqrt(self.depth)
+        self.block_size = block_size
 
         # d_model divisible by num_heads
         assert d_model % num_heads == 0, "d_model must be divisible by num_heads"
 
-        # linear projections
-        self.wq = tf.keras.layers.Dense(d_model)
-        self.wk = tf.keras.layers.Dense(d_model)
-        self.wv = tf.keras.layers.Dense(d_model)
+        # fused query/key/value projection (one matmul instead of three);
+        # fan_in scaling keeps the init variance of three separate Dense layers
+        self.wqkv = tf.keras.layers.Dense(
+            3 * d_model,
+            kernel_initializer=tf.keras.initializers.VarianceScaling(
+                scale=1.0, mode='fan_in', distribution='uniform'
+            )
+        )
 
         self.linear = tf.keras.layers.Dense(d_model)
 
-    def split_heads(self, x):
-        """
-        Split the last dimension into (num_heads, depth)
-        and transpose to (batch_size, num_heads, seq_len, depth)
-        """
-        batch_size = tf.shape(x)[0]
-        seq_len = tf.shape(x)[1]
-
-        x = tf.reshape(x, (batch_size, seq_len, self.num_heads, self.depth))
+        # XLA-compiled forward passes keyed by (function, seq_len bucket,
+        # return_attention), so every traced graph has a static sequence length
+        # and doesn't branch on return_attention
+        self._compiled_forwards = {}
 
-        return tf.transpose(x, perm=[0, 2, 1, 3])
+    def build(self, input_shape):
+        # create the weights up front so they aren't created while tracing;
+        # project_qkv/apply_attention may already have built the sublayers
+        if not self.wqkv.built:
+            self.wqkv.build(input_shape)
+        if not self.linear.built:
+            self.linear.build((None, None, self.d_model))
 
-    def scaled_dot_product_attention(self, q, k, v, mask=None):
+    def scaled_dot_product_attention(self, q, k, v, mask=None, return_attention=True):
         """
         Calc attention weights and apply them to values.
 
+        q, k and v are laid out as (batch_size, seq_len, num_heads, depth) and
+        mask is additive (see generate_attention_mask).
+        When return_attention is False the weights are not returned: sequences
+        longer than block_size go through the tiled kernel, which never
+        materializes the (seq_len, seq_len) matrix; shorter ones go through
+        tf.keras.ops.dot_product_attention (see fused_attention).
+
         Returns:
-            output: Weighted sum based on attention scores
-            attention_weights: The attention weights used
+            output: Weighted sum based on attention scores, same layout as q
+            attention_weights: The attention weights used (None if not requested),
+                shape (batch_size, num_heads, seq_len, seq_len)
         """
-        matmul_qk = tf.matmul(q, k, transpose_b=True)
+        if not return_attention:
+            seq_len = q.shape[1]
+
+            # long sequences go through the tiled kernel
+            if seq_len is not None and seq_len > self.block_size:
+                return self.flash_attention_forward(q, k, v, mask), None
+
+            if seq_len is not None:
+                return self.fused_attention(q, k, v, mask), None
+
+            # length only known at run time
+            output = tf.cond(
+                tf.shape(q)[1] > self.block_size,
+                lambda: self.flash_attention_forward(q, k, v, mask),
+                lambda: self.fused_attention(q, k, v, mask)
+            )
 
-        # scale attention scores
-        dk = tf.cast(tf.shape(k)[-1], tf.float32)
-        scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+            return output, None
+
+        # scale attention scores (applied to q, which is smaller than the scores);
+        # logits and softmax in float32 for numerical stability
+        scaled_attention_logits = tf.cast(
+            tf.einsum('bqhd,bkhd->bhqk', q * self.scale, k), tf.float32
+        )
 
         # apply mask (if provided)
         if mask is not None:
-            scaled_attention_logits += (mask * -1e9)
+            scaled_attention_logits += tf.cast(mask[:, tf.newaxis, :, :], tf.float32)
 
         # apply softmax
         attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)
 
-        output = tf.matmul(attention_weights, v)
+        output = tf.einsum('bhqk,bkhd->bqhd', tf.cast(attention_weights, v.dtype), v)
 
         return output, attention_weights
 
-    def call(self, x, mask=None, return_attention=False):
+    def fused_attention(self, q, k, v, mask=None):
+        """
+        Attention through tf.keras.ops.dot_product_attention.
+
+        On the TensorFlow backend Keras has no fused kernel for this op: it runs
+        the same einsum / full logits / float32 softmax / einsum sequence as the
+        explicit path, so the (seq_len, seq_len) logits are still materialized.
+        It's a different code path only, with no memory savings; backends with
+        flash attention support can dispatch it to a fused kernel.
+        """
+        # additive mask as a bias, broadcast over heads
+        bias = tf.cast(mask[:, tf.newaxis, :, :], q.dtype) if mask is not None else None
+
+        return tf.keras.ops.dot_product_attention(
+            q, k, v, bias=bias, scale=self.scale
+        )
+
+    @tf.function(jit_compile=True)
+    def flash_attention_forward(self, q, k, v, mask=None):
+        """
+        Tiled attention with an online softmax (FlashAttention forward pass).
+
+        Keys and values are visited one block at a time while a running row max
+        and row sum rescale the partial output, so the full (seq_len, seq_len)
+        score matrix is never materialized. Query rows don't depend on each
+        other, so all query tiles are processed together.
+
+        Returns:
+            output: Weighted sum based on attention scores, same layout as q
+        """
+        seq_len = tf.shape(k)[1]
+        num_blocks = (seq_len + self.block_size - 1) // self.block_size
+        pad = num_blocks * self.block_size - seq_len
+
+        # pad keys/values to a whole number of blocks and mask out the padding
+        k = tf.pad(k, [[0, 0], [0, pad], [0, 0], [0, 0]])
+        v = tf.pad(v, [[0, 0], [0, pad], [0, 0], [0, 0]])
+        if mask is None:
+            mask = tf.zeros((1, tf.shape(q)[1], seq_len))
+        mask = tf.broadcast_to(
+            tf.cast(mask, tf.float32), [tf.shape(mask)[0], tf.shape(q)[1], seq_len]
+        )
+        mask = tf.pad(mask, [[0, 0], [0, 0], [0, pad]], constant_values=-1e9)
+        mask = mask[:, :, tf.newaxis, :]
+
+        q = q * self.scale
+
+        # running row max, row sum and unnormalized output, kept in float32
+        m = tf.fill(tf.concat([tf.shape(q)[:-1], [1]], axis=0), -np.inf)
+        l = tf.zeros_like(m)
+        o = tf.zeros(tf.shape(q))
+
+        def step(j, m, l, o):
+            start = j * self.block_size
+            k_j = tf.slice(k, [0, start, 0, 0], [-1, self.block_size, -1, -1])
+            v_j = tf.slice(v, [0, start, 0, 0], [-1, self.block_size, -1, -1])
+            mask_j = tf.slice(mask, [0, 0, 0, start], [-1, -1, -1, self.block_size])
+
+            s_ij = tf.cast(tf.einsum('bqhd,bkhd->bqhk', q, k_j), tf.float32) + mask_j
+
+            # online softmax update
+            m_new = tf.maximum(m, tf.reduce_max(s_ij, axis=-1, keepdims=True))
+            p_ij = tf.exp(s_ij - m_new)
+            alpha = tf.exp(m - m_new)
+
+            l = alpha * l + tf.reduce_sum(p_ij, axis=-1, keepdims=True)
+            p_v = tf.einsum('bqhk,bkhd->bqhd', tf.cast(p_ij, v_j.dtype), v_j)
+            o = alpha * o + tf.cast(p_v, tf.float32)
+
+            return j + 1, m_new, l, o
+
+        _, m, l, o = tf.while_loop(
+            lambda j, m, l, o: j < num_blocks, step, (0, m, l, o)
+        )
+
+        return tf.cast(o / l, q.dtype)
+
+    def project_qkv(self, x):
+        """
+        Project the input to queries, keys and values and split the heads.
+
+        The result can be passed to apply_attention several times (e.g. with
+        different masks) without re-running the projection.
+
+        Returns:
+            q, k, v: Each with shape (batch_size, seq_len, num_heads, depth)
+        """
         batch_size = tf.shape(x)[0]
         seq_len = tf.shape(x)[1]
 
         # linear projections
-        q = self.wq(x)
-        k = self.wk(x)
-        v = self.wv(x)
+        qkv = self.wqkv(x)
+
+        # split into q/k/v and heads: (batch_size, seq_len, num_heads, depth) each
+        qkv = tf.reshape(qkv, (batch_size, seq_len, 3, self.num_heads, self.depth))
+        return tf.unstack(qkv, axis=2)
 
-        # split heads
-        q = self.split_heads(q)
-        k = self.split_heads(k)
-        v = self.split_heads(v)
+    def _attend(self, q, k, v, mask=None, return_attention=False):
+        """Attend over projected q/k/v and apply the output projection"""
+        batch_size = tf.shape(q)[0]
+        seq_len = tf.shape(q)[1]
 
         scaled_attention, attention_weights = self.scaled_dot_product_attention(
-            q, k, v, mask
+            q, k, v, mask, return_attention
         )
 
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
-
         concat_attention = tf.reshape(scaled_attention, (batch_size, seq_len, self.d_model))
 
         # final layer
@@ -135,27 +259,99 @@ class SelfAttention(tf.keras.layers.Layer):
 
         return output
 
+    def _project_and_attend(self, x, mask=None, return_attention=False):
+        q, k, v = self.project_qkv(x)
+        return self._attend(q, k, v, mask, return_attention)
+
+    def _run_bucketed(self, fn, inputs, mask, return_attention):
+        """
+        Run fn(*inputs, mask) through an XLA-compiled graph with a static length.
+
+        The inputs are padded along the sequence axis to the next power of two
+        (at least 4 tokens), so a handful of static-shape graphs covers every
+        sentence length. Compiled graphs are cached by (fn, bucket,
+        return_attention).
+        """
+        seq_len = inputs[0].shape[1]
+
+        if not seq_len:
+            # length unknown while tracing (e.g. tf.keras.Input(shape=(None, d_model)))
+            # or empty input: no static bucket, run fn as is
+            return fn(*inputs, mask, return_attention=return_attention)
+
+        bucket = max(4, 2 ** math.ceil(math.log2(seq_len)))
+        pad = bucket - seq_len
+
+        if mask is None:
+            mask = tf.zeros((1, 1, 1), dtype=self.compute_dtype)
+        mask = tf.cast(mask, self.compute_dtype)
+        mask = tf.broadcast_to(mask, [tf.shape(mask)[0], seq_len, seq_len])
+
+        # padded keys are masked out, padded queries are sliced off below
+        mask = tf.pad(mask, [[0, 0], [0, 0], [0, pad]], constant_values=-1e9)
+        mask = tf.pad(mask, [[0, 0], [0, pad], [0, 0]])
+        inputs = [
+            tf.pad(tf.cast(t, self.compute_dtype), [[0, 0], [0, pad]] + [[0, 0]] * (t.shape.rank - 2))
+            for t in inputs
+        ]
+
+        key = (fn.__name__, bucket, return_attention)
+        if key not in self._compiled_forwards:
+            input_signature = [
+                tf.TensorSpec([None, bucket] + t.shape[2:], self.compute_dtype) for t in inputs
+            ] + [tf.TensorSpec([None, bucket, bucket], self.compute_dtype)]
+            self._compiled_forwards[key] = tf.function(
+                functools.partial(fn, return_attention=return_attention),
+                jit_compile=True, input_signature=input_signature
+            )
+
+        compiled = self._compiled_forwards[key]
+
+        if return_attention:
+            output, attention_weights = compiled(*inputs, mask)
+            return output[:, :seq_len], attention_weights[:, :, :seq_len, :seq_len]
+
+        return compiled(*inputs, mask)[:, :seq_len]
+
+    def apply_attention(self, q, k, v, mask=None, return_attention=False):
+        """
+        Attend over projected q/k/v and apply the output projection.
+
+        Runs through the same bucketed, XLA-compiled path as calling the layer.
+        """
+        if not self.linear.built:
+            self.linear.build((None, None, self.d_model))
+
+        return self._run_bucketed(self._attend, [q, k, v], mask, return_attention)
+
+    def call(self, x, mask=None, return_attention=False):
+        return self._run_bucketed(self._project_and_attend, [x], mask, return_attention)
+
 """## Creating input data for visualization
 
 To 'show' attention, we'll work with some sample sentences and visualize how the attention mechanism focuses on different words.
 """
 
+@functools.lru_cache(maxsize=256)
 def preprocess_sentence(sentence):
-    return sentence.lower().split()
+    # cached, so tokens are returned as an immutable tuple
+    return tuple(sentence.lower().split())
 
 def create_simple_embeddings(tokens, embed_dim=64):
     # random embeddings for each token
-    embeddings = np.random.normal(0, 1, (len(tokens), embed_dim))
+    embeddings = rng.standard_normal((len(tokens), embed_dim), dtype=np.float32)
 
     # let similar words have similar embeddings
-    for i, token in enumerate(tokens):
-        # (heuristic) first letter contributes 50% of the embedding pattern
-        first_letter = ord(token[0]) - ord('a') if token and token[0].isalpha() else 0
-        mask = np.ones(embed_dim)
-        mask[:embed_dim//2] = first_letter / 26.0
-        embeddings[i] *= mask
+    # (heuristic) first letter contributes 50% of the embedding pattern
+    first_letters = np.array(
+        [ord(t[0]) - ord('a') if t and t[0].isalpha() else 0 for t in tokens],
+        dtype=np.float32
+    ) / 26.0
+    scale = np.ones((len(tokens), embed_dim), dtype=np.float32)
+    scale[:, :embed_dim//2] = first_letters[:, np.newaxis]
+    embeddings *= scale
 
-    return tf.convert_to_tensor(embeddings, dtype=tf.float32)
+    return tf.constant(embeddings)
 
 def prepare_input(sentence, embed_dim=64):
     """Prepare a sentence for attention visualization"""
@@ -166,12 +362,73 @@ def prepare_input(sentence, embed_dim=64):
     embeddings = tf.expand_dims(embeddings, 0)
     return tokens, embeddings
 
+def prepare_batch(sentences, embed_dim=64):
+    """
+    Prepare several sentences as one zero-padded batch, so a single attention
+    call handles all of them.
+
+    Returns:
+        tokens: List of token tuples, one per sentence
+        embeddings: Tensor of shape (batch, max_len, embed_dim)
+        padding_mask: Additive mask of shape (batch, 1, max_len) that blocks
+            attention to padded positions
+    """
+    inputs = [prepare_input(sentence, embed_dim) for sentence in sentences]
+    tokens = [t for t, _ in inputs]
+    lengths = np.array([len(t) for t in tokens])
+    max_len = lengths.max()
+
+    embeddings = tf.concat(
+        [tf.pad(e, [[0, 0], [0, max_len - len(t)], [0, 0]]) for t, e in inputs], axis=0
+    )
+
+    padded = np.arange(max_len)[np.newaxis, :] >= lengths[:, np.newaxis]
+    padding_mask = tf.constant((padded * -1e9)[:, np.newaxis, :], dtype=tf.float32)
+
+    return tokens, embeddings, padding_mask
+
+def split_batch_attention(tokens, attention_weights):
+    """Slice batched attention weights into one [1, heads, len, len] tensor per sentence"""
+    return [attention_weights[i:i + 1, :, :len(t), :len(t)] for i, t in enumerate(tokens)]
+
 """## Visualizing attention patterns
 
 Now we'll create functions to visualize how attention weights distribute across tokens.
 """
 
-def visualize_attention(tokens, attention_weights, head_index=0, title="Attention Weights"):
+# cell annotations are unreadable and slow to render past this many tokens
+MAX_ANNOTATED_TOKENS = 16
+
+def plot_attention_heatmap(ax, attn, tokens, top_k=3):
+    """
+    Draw an attention matrix on ax as a single image.
+
+    Only the top_k weights of each query row are annotated, instead of
+    placing a text object in every cell.
+
+    Args:
+        ax: Matplotlib axes to draw into
+        attn: Attention matrix with shape [seq_len, seq_len]
+        tokens: List of input tokens
+        top_k: Number of annotated weights per row
+    """
+    im = ax.imshow(attn, cmap=attention_colors, aspect='auto')
+    ax.figure.colorbar(im, ax=ax)
+
+    if len(tokens) <= MAX_ANNOTATED_TOKENS:
+        # light text on the dark end of the colormap
+        threshold = (attn.min() + attn.max()) / 2
+        for i, row in enumerate(np.argsort(attn, axis=1)[:, -top_k:]):
+            for j in row:
+                ax.text(j, i, f"{attn[i, j]:.2f}", ha='center', va='center',
+                        color='white' if attn[i, j] > threshold else 'black')
+
+    ax.set_xticks(range(len(tokens)))
+    ax.set_xticklabels(tokens, rotation=45, ha='right')
+    ax.set_yticks(range(len(tokens)))
+    ax.set_yticklabels(tokens)
+
+def visualize_attention(tokens, attention_weights, head_index=0, title="Attention Weights", ax=None):
     """
     Visualize attention weights for a specific head.
 
@@ -180,24 +437,30 @@ def visualize_attention(tokens, attention_weights, head_index=0, title="Attentio
         attention_weights: Attention weights tensor with shape [batch, heads, seq_len, seq_len]
         head_index: Which attention head to visualize
         title: Title for the plot
+        ax: Existing axes to draw into (cleared first); the caller is then
+            responsible for showing the figure. A new figure is created if None.
     """
     attn = attention_weights[0, head_index].numpy()
 
-    fig, ax = plt.subplots(figsize=(10, 8))
+    show = ax is None
+    if show:
+        fig, ax = plt.subplots(figsize=(10, 8))
+    else:
+        # drop the colorbar of a previous heatmap before reusing the axes
+        for image in ax.images:
+            if image.colorbar is not None:
+                image.colorbar.remove()
+        ax.clear()
 
-    sns.heatmap(attn,
-                annot=True,
-                cmap=attention_colors,
-                fmt='.2f',
-                xticklabels=tokens,
-                yticklabels=tokens,
-                ax=ax)
+    plot_attention_heatmap(ax, attn, tokens)
 
     ax.set_title(f"{title} (Head {head_index})")
     ax.set_ylabel("Query (from)")
     ax.set_xlabel("Key (to)")
-    plt.tight_layout()
-    plt.show()
+
+    if show:
+        plt.tight_layout()
+        plt.show()
 
 def visualize_all_heads(tokens, attention_weights, ncols=2, title="Attention Heads"):
     """
@@ -212,6 +475,9 @@ def visualize_all_heads(tokens, attention_weights, ncols=2, title="Attention Hea
     num_heads = attention_weights.shape[1]
     nrows = math.ceil(num_heads / ncols)
 
+    # single device-to-host copy for all heads
+    attn_all = attention_weights[0].numpy()
+
     fig, axes = plt.subplots(nrows, ncols, figsize=(15, 3*nrows))
     if nrows == 1 and ncols == 1:
         axes = np.array([axes])
@@ -219,14 +485,7 @@ def visualize_all_heads(tokens, attention_weights, ncols=2, title="Attention Hea
 
     for i in range(num_heads):
         if i < num_heads:
-            attn = attention_weights[0, i].numpy()
-            sns.heatmap(attn,
-                        annot=True,
-                        cmap=attention_colors,
-                        fmt='.2f',
-                        xticklabels=tokens,
-                        yticklabels=tokens,
-                        ax=axes[i])
+            plot_attention_heatmap(axes[i], attn_all[i], tokens)
             axes[i].set_title(f"Head {i}")
         else:
             axes[i].axis('off')
@@ -270,23 +529,19 @@ Let's explore how attention captures different linguistic relationships by exami
 
 # example two: sentence with pronoun reference
 sentence2 = "John said he would arrive tomorrow"
-tokens2, embeddings2 = prepare_input(sentence2, d_model)
-
-# apply attention
-_, attention_weights2 = attention_layer(embeddings2, return_attention=True)
-
-# visualize
-visualize_all_heads(tokens2, attention_weights2,
-                   title="Attention for Pronoun Reference")
 
 # example three: sentence with semantic relationships
 sentence3 = "The chef cooked a delicious meal with fresh ingredients"
-tokens3, embeddings3 = prepare_input(sentence3, d_model)
 
-# apply attention
-_, attention_weights3 = attention_layer(embeddings3, return_attention=True)
+# apply attention to both sentences as one padded batch
+(tokens2, tokens3), embeddings23, padding_mask = prepare_batch([sentence2, sentence3], d_model)
+_, attention_weights23 = attention_layer(embeddings23, mask=padding_mask, return_attention=True)
+attention_weights2, attention_weights3 = split_batch_attention([tokens2, tokens3], attention_weights23)
 
 # visualize
+visualize_all_heads(tokens2, attention_weights2,
+                   title="Attention for Pronoun Reference")
+
 visualize_all_heads(tokens3, attention_weights3,
                    title="Attention for Semantic Relationships")
 
@@ -295,9 +550,12 @@ visualize_all_heads(tokens3, attention_weights3,
 Different types of attention patterns serve different purposes in transformer models. Let's implement and visualize some common patterns:
 """
 
+# masks only depend on (length, pattern_type), so build each one once
+_attention_mask_cache = {}
+
 def generate_attention_mask(length, pattern_type):
     """
-    Generate attention masks for different patterns.
+    Generate additive attention masks for different patterns.
 
     Args:
         length: Sequence length
@@ -307,55 +565,69 @@ def generate_attention_mask(length, pattern_type):
             - 'global-local': Combination of global tokens and local attention
 
     Returns:
-        mask: Boolean mask where False indicates positions to attend to
+        mask: Additive mask, 0 where attention is allowed and -1e9 where it is
+            blocked, ready to be added to the attention logits
     """
+    key = (length, pattern_type)
+    if key in _attention_mask_cache:
+        return _attention_mask_cache[key]
+
     if pattern_type == 'causal':
         # lower triangular mask (can't see future tokens)
-        mask = 1 - np.tril(np.ones((1, length, length)))
+        mask = 1 - np.tril(np.ones((1, length, length), dtype=np.float32))
 
     elif pattern_type == 'local':
         # band diagonal mask (can only see nearby tokens)
         window_size = max(1, length // 4)
-        mask = np.ones((1, length, length))
-        for i in range(length):
-            start = max(0, i - window_size)
-            end = min(length, i + window_size + 1)
-            mask[0, i, start:end] = 0
+        idx = np.arange(length)
+        local_band = np.abs(idx[:, np.newaxis] - idx[np.newaxis, :]) <= window_size
+        mask = (~local_band)[np.newaxis].astype(np.float32)
 
     elif pattern_type == 'global-local':
         # first tokens are global, rest have local attention
         num_global = max(1, length // 5)
-        mask = np.ones((1, length, length))
+        window_size = max(1, length // 4)
+        idx = np.arange(length)
+
+        # local attention for every token
+        local_band = np.abs(idx[:, np.newaxis] - idx[np.newaxis, :]) <= window_size
 
         # global tokens attend to all tokens
-        mask[0, :num_global, :] = 0
+        global_row = idx[:, np.newaxis] < num_global
 
         # all tokens attend to global tokens
-        mask[0, :, :num_global] = 0
+        global_col = idx[np.newaxis, :] < num_global
 
-        # local attention for non-global tokens
-        window_size = max(1, length // 4)
-        for i in range(num_global, length):
-            start = max(num_global, i - window_size)
-            end = min(length, i + window_size + 1)
-            mask[0, i, start:end] = 0
+        attend = local_band | global_row | global_col
+        mask = (~attend)[np.newaxis].astype(np.float32)
 
     else:
         # no mask (standard self-attention)
-        mask = np.zeros((1, length, length))
+        mask = np.zeros((1, length, length), dtype=np.float32)
 
-    return tf.convert_to_tensor(mask, dtype=tf.float32)
+    mask = tf.constant(mask * np.float32(-1e9))
+    _attention_mask_cache[key] = mask
+    return mask
 
-def visualize_attention_pattern(pattern_type, sentence):
-    """Visualize a specific attention pattern on a sentence"""
-    tokens, embeddings = prepare_input(sentence, d_model)
-    seq_len = embeddings.shape[1]
+def visualize_attention_pattern(pattern_type, sentence, qkv=None):
+    """
+    Visualize a specific attention pattern on a sentence.
+
+    If qkv (from attention_layer.project_qkv) is given, those projections are
+    reused instead of embedding and projecting the sentence again.
+    """
+    if qkv is None:
+        tokens, embeddings = prepare_input(sentence, d_model)
+        qkv = attention_layer.project_qkv(embeddings)
+    else:
+        tokens = preprocess_sentence(sentence)
+    seq_len = len(tokens)
 
     # generate the appropriate mask
     mask = generate_attention_mask(seq_len, pattern_type)
 
     # apply attention with mask
-    _, attention_weights = attention_layer(embeddings, mask=mask, return_attention=True)
+    _, attention_weights = attention_layer.apply_attention(*qkv, mask=mask, return_attention=True)
 
     # visualize
     visualize_all_heads(tokens, attention_weights,
@@ -363,7 +635,7 @@ def visualize_attention_pattern(pattern_type, sentence):
 
     # show the mask too
     plt.figure(figsize=(6, 5))
-    plt.imshow(mask[0], cmap='binary')
+    plt.imshow(mask[0] < 0, cmap='binary')
     plt.colorbar()
     plt.title(f"'{pattern_type}' Attention Mask")
     plt.xticks(range(len(tokens)), tokens)
@@ -379,19 +651,21 @@ Let's compare different attention patterns on the same sentence:
 sample_sentence = "Transformers have revolutionized natural language processing"
 
 # standard attention (no mask)
-_, embeddings = prepare_input(sample_sentence, d_model)
-_, attention_weights = attention_layer(embeddings, return_attention=True)
-tokens = preprocess_sentence(sample_sentence)
+tokens, embeddings = prepare_input(sample_sentence, d_model)
+
+# project once, every pattern below reuses the same q/k/v
+qkv = attention_layer.project_qkv(embeddings)
+_, attention_weights = attention_layer.apply_attention(*qkv, return_attention=True)
 visualize_all_heads(tokens, attention_weights, title="Standard Self-Attention")
 
 # causal attention (decoder-style)
-visualize_attention_pattern('causal', sample_sentence)
+visualize_attention_pattern('causal', sample_sentence, qkv=qkv)
 
 # local attention
-visualize_attention_pattern('local', sample_sentence)
+visualize_attention_pattern('local', sample_sentence, qkv=qkv)
 
 # global-local attention
-visualize_attention_pattern('global-local', sample_sentence)
+visualize_attention_pattern('global-local', sample_sentence, qkv=qkv)
 
 """## Comparing attention in different length sequences
 
@@ -405,13 +679,41 @@ long_sentence = "This is a much longer sentence that will help us understand how
 sentences = [short_sentence, medium_sentence, long_sentence]
 labels = ["Short", "Medium", "Long"]
 
-for sentence, label in zip(sentences, labels):
-    tokens, embeddings = prepare_input(sentence, d_model)
-    _, attention_weights = attention_layer(embeddings, return_attention=True)
+# one attention call for all three lengths
+all_tokens, embeddings, padding_mask = prepare_batch(sentences, d_model)
+_, batch_attention_weights = attention_layer(embeddings, mask=padding_mask, return_attention=True)
+
+# draw every sequence into a single figure
+fig, axes = plt.subplots(len(sentences), 1, figsize=(10, 8 * len(sentences)))
 
+for tokens, attention_weights, label, ax in zip(
+        all_tokens, split_batch_attention(all_tokens, batch_attention_weights), labels, axes):
     # Just look at first head for simplicity
     visualize_attention(tokens, attention_weights, head_index=0,
-                        title=f"{label} Sequence Attention")
+                        title=f"{label} Sequence Attention", ax=ax)
+
+plt.tight_layout()
+plt.show()
+
+"""## Attention without returning the weights
+
+When the attention weights aren't needed, sequences longer than `block_size` (64 tokens) use the tiled online-softmax kernel, which never builds the full (seq_len, seq_len) matrix. Shorter sequences go through `tf.keras.ops.dot_product_attention`, which on the TensorFlow backend still computes the full matrix internally, just without returning it. Both should agree with the explicit path used for the plots above:
+"""
+
+very_long_sentence = " ".join([long_sentence] * 3)
+
+for sentence, label in [(long_sentence, "Long"), (very_long_sentence, "Very long")]:
+    tokens, embeddings = prepare_input(sentence, d_model)
+
+    # no weights requested: tiled kernel past block_size tokens, otherwise
+    # dot_product_attention (full matrix internally on the TF backend)
+    output = attention_layer(embeddings)
+    reference, _ = attention_layer(embeddings, return_attention=True)
+
+    max_diff = tf.reduce_max(tf.abs(tf.cast(output - reference, tf.float32)))
+    kernel = "tiled kernel" if len(tokens) > attention_layer.block_size else "dot_product_attention"
+    print(f"{label} ({len(tokens)} tokens, {kernel}): "
+          f"max difference to explicit attention {float(max_diff):.4f}")
 
 """## Interactive attention visualization
 
@@ -433,15 +735,18 @@ def analyze_attention(sentence, pattern_type=None):
     visualize_all_heads(tokens, attention_weights, title=title)
 
     # avg attention across heads
-    avg_attention = tf.reduce_mean(attention_weights, axis=1).numpy()[0]
+    avg_attention = tf.reduce_mean(attention_weights[0], axis=0)
 
-    # most attended token for each position
-    most_attended_indices = np.argmax(avg_attention, axis=1)
+    # most attended token for each position, only the indices and values
+    # are copied back to the host
+    most_attended = tf.argmax(avg_attention, axis=-1)
+    attention_values = tf.gather(avg_attention, most_attended, batch_dims=1).numpy()
+    most_attended_indices = most_attended.numpy()
 
     print("Most attended tokens:")
     for i, token in enumerate(tokens):
         attended_token = tokens[most_attended_indices[i]]
-        print(f"  '{token}' → '{attended_token}' (attention: {avg_attention[i, most_attended_indices[i]]:.2f})")
+        print(f"  '{token}' → '{attended_token}' (attention: {attention_values[i]:.2f})")
 
 # test with a custom sentence
 custom_sentence = "The algorithm efficiently processes large datasets"
@@ -465,21 +770,27 @@ This implementation is simplified for practice purposes - production models will
 One limitation of the basic attention mechanism is that it doesn't inherently understand the position of tokens. Let's briefly demonstrate this and show how positional encoding helps:
 """
 
-def add_simple_positional_encoding(embeddings):
-    """Add simple positional encoding to the embeddings"""
-    batch_size, seq_len, d_model = embeddings.shape
-    positions = np.arange(seq_len)[:, np.newaxis]
+@functools.lru_cache(maxsize=32)
+def _positional_encoding_table(seq_len, d_model):
+    """Sine/cosine table of shape (1, seq_len, d_model), built once per shape"""
+    positions = np.arange(seq_len, dtype=np.float32)
 
     # simple encoding based on sine/cosine functions with different frequencies
-    div_term = np.exp(np.arange(0, d_model, 2) * -(math.log(10000.0) / d_model))
+    div_term = np.exp(np.arange(0, d_model, 2, dtype=np.float32) * -(math.log(10000.0) / d_model))
+    angles = np.outer(positions, div_term)
 
-    pos_encoding = np.zeros((seq_len, d_model))
-    pos_encoding[:, 0::2] = np.sin(positions * div_term)
-    pos_encoding[:, 1::2] = np.cos(positions * div_term)
+    pos_encoding = np.empty((seq_len, d_model), dtype=np.float32)
+    pos_encoding[:, 0::2] = np.sin(angles)
+    pos_encoding[:, 1::2] = np.cos(angles)
+
+    return tf.constant(pos_encoding[np.newaxis, :, :])
+
+def add_simple_positional_encoding(embeddings):
+    """Add simple positional encoding to the embeddings"""
+    batch_size, seq_len, d_model = embeddings.shape
 
     # add positional encoding to the embeddings
-    result = embeddings + tf.convert_to_tensor(pos_encoding[np.newaxis, :, :], dtype=tf.float32)
-    return result
+    return embeddings + _positional_encoding_table(seq_len, d_model)
 
 # illustrate with the same sentence in different word orders
 original = "the cat sat on the mat"
@@ -500,27 +811,19 @@ _, attn_orig_pos = attention_layer(embed_orig_pos, return_attention=True)
 _, attn_jumbled_pos = attention_layer(embed_jumbled_pos, return_attention=True)
 
 # visualize
-plt.figure(figsize=(15, 12))
-
-plt.subplot(2, 2, 1)
-sns.heatmap(attn_orig[0, 0].numpy(), annot=True, cmap=attention_colors,
-            xticklabels=tokens_orig, yticklabels=tokens_orig)
-plt.title("Original Sentence (No Position Info)")
-
-plt.subplot(2, 2, 2)
-sns.heatmap(attn_jumbled[0, 0].numpy(), annot=True, cmap=attention_colors,
-            xticklabels=tokens_jumbled, yticklabels=tokens_jumbled)
-plt.title("Jumbled Sentence (No Position Info)")
-
-plt.subplot(2, 2, 3)
-sns.heatmap(attn_orig_pos[0, 0].numpy(), annot=True, cmap=attention_colors,
-            xticklabels=tokens_orig, yticklabels=tokens_orig)
-plt.title("Original Sentence (With Position Info)")
-
-plt.subplot(2, 2, 4)
-sns.heatmap(attn_jumbled_pos[0, 0].numpy(), annot=True, cmap=attention_colors,
-            xticklabels=tokens_jumbled, yticklabels=tokens_jumbled)
-plt.title("Jumbled Sentence (With Position Info)")
+fig, axes = plt.subplots(2, 2, figsize=(15, 12))
+
+plot_attention_heatmap(axes[0, 0], attn_orig[0, 0].numpy(), tokens_orig)
+axes[0, 0].set_title("Original Sentence (No Position Info)")
+
+plot_attention_heatmap(axes[0, 1], attn_jumbled[0, 0].numpy(), tokens_jumbled)
+axes[0, 1].set_title("Jumbled Sentence (No Position Info)")
+
+plot_attention_heatmap(axes[1, 0], attn_orig_pos[0, 0].numpy(), tokens_orig)
+axes[1, 0].set_title("Original Sentence (With Position Info)")
+
+plot_attention_heatmap(axes[1, 1], attn_jumbled_pos[0, 0].numpy(), tokens_jumbled)
+axes[1, 1].set_title("Jumbled Sentence (With Position Info)")
 
 plt.tight_layout()
 plt.show()